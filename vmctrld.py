@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
+import math
+import re
 import sys
-from subprocess import Popen, PIPE
-from threading import Thread, Condition, Event
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE, run
+from threading import Thread, Lock, Event
 
 DRY = False
+# Upper limit of concurrently spawned qm/pct processes
+MAX_WORKERS = 16
 
 class Status:
 	UNKNOWN = -1
@@ -42,8 +48,11 @@ def inv_dict(d):
 status_str = inv_dict(str_status)
 cmd_str = inv_dict(str_cmd)
 
+_KV_RE = re.compile(r"([^=,]+)=([^,]*)")
+_CFG_RE = re.compile(r"^([^#:\n][^:\n]*): (.*?)[ \t\r]*$", re.MULTILINE)
+
 def str_to_dict(s):
-	return dict(item.split("=") for item in s.split(","))
+	return dict(_KV_RE.findall(s))
 
 class Sleep:
 	def __init__(self):
@@ -55,8 +64,21 @@ class Sleep:
 	def clear(self):
 		self.__event.clear()
 
+# Descriptors are non-inheritable by default, so skip closing them all in the child
 def program(*args, **kwargs):
-	return Popen([*args], **kwargs)
+	return Popen([*args], close_fds=False, **kwargs)
+
+def run_capture(*args):
+	return run([*args], capture_output=True, text=True, close_fds=False).stdout
+
+def read_config(path):
+	try:
+		with open(path) as f:
+			data = f.read()
+	except OSError:
+		return None
+	# Snapshots follow the current config in their own sections
+	return data.split("\n[", 1)[0]
 
 class qm:
 	@staticmethod
@@ -79,13 +101,14 @@ class qm:
 		return program("qm", "stop", vmid)
 	@staticmethod
 	def config(vmid):
-		return program("qm", "config", vmid, stdout=PIPE)
+		return read_config("/etc/pve/qemu-server/{}.conf".format(vmid)) or run_capture("qm", "config", vmid)
 	@staticmethod
 	def status(vmid):
 		return program("qm", "status", vmid, stdout=PIPE)
 	@staticmethod
 	def list():
-		return program("qm", "list", stdout=PIPE)
+		# Full status reports paused units properly
+		return program("qm", "list", "--full", stdout=PIPE)
 
 class pct:
 	@staticmethod
@@ -109,7 +132,7 @@ class pct:
 		return program("pct", "stop", vmid)
 	@staticmethod
 	def config(vmid):
-		return program("pct", "config", vmid, stdout=PIPE)
+		return read_config("/etc/pve/lxc/{}.conf".format(vmid)) or run_capture("pct", "config", vmid)
 	@staticmethod
 	def status(vmid):
 		return program("pct", "status", vmid, stdout=PIPE)
@@ -124,7 +147,10 @@ class VirtualUnit:
 		self.name = name
 		self.status = status
 		# Cache
-		self.__config = {}
+		self.__config = None
+		self._onboot = None
+		self._order = None
+		self._delay_up = None
 	def __change_state(self, new_status, old_status, cmd):
 		if self.status in old_status:
 			return
@@ -147,17 +173,19 @@ class VirtualUnit:
 	def stop(self):
 		self.__change_state(Status.STOPPED, [Status.STOPPED], self.__prgm.stop)
 	def config(self, *, force=False):
-		if not force and len(self.__config):
+		if not force and self.__config is not None:
 			return self.__config
-		proc = self.__prgm.config(self.vmid)
-		proc.stdout.readline()
-		config = {}
-		for line in proc.stdout.readlines():
-			(key, val) = line.decode().strip().split(": ")
-			config[key] = val
-		proc.wait()
+		out = self.__prgm.config(self.vmid)
+		config = dict(_CFG_RE.findall(out))
 		self.__config = config
 		return config
+	def _prime_cache(self):
+		if self._order is not None:
+			return
+		self.config()
+		self._onboot = self.onboot()
+		self._order = self.order()
+		self._delay_up = self.delay_up()
 	def running(self):
 		return self.status == Status.RUNNING
 	def onboot(self):
@@ -171,7 +199,7 @@ class VirtualUnit:
 			startup = str_to_dict(config["startup"])
 			if "order" in startup:
 				return int(startup["order"])
-		return 2**10000 # Infinite enough
+		return math.inf
 	def delay_up(self):
 		config = self.config()
 		if "startup" in config:
@@ -185,7 +213,9 @@ class VirtualUnit:
 			return config["tags"].split(';')
 		return []
 	def __eq__(self, other):
-		return self.vmid == other
+		return isinstance(other, VirtualUnit) and self.vmid == other.vmid
+	def __hash__(self):
+		return hash(self.vmid)
 
 class UnitAction:
 	def __init__(self, cmd, unit, run):
@@ -196,75 +226,109 @@ class UnitAction:
 	def __call__(self):
 		return self.__run(self.unit)
 
-	def __eq__(self, other):
-		return self.unit == other
-
 	def should_cancel(self, action):
 		return self.cmd != action.cmd
 
+	def batches_with(self, action):
+		# Units sharing the same order have no dependency between them,
+		# unless an up delay has to pass before the next one
+		return (isinstance(action, UnitAction) and self.cmd == action.cmd
+			and self.unit._order is not None and self.unit._delay_up is None
+			and self.unit._order == action.unit._order)
+
 class Daemon:
 	def __init__(self, *args, **kwargs):
-		self.__lock = Condition()
-		self.__queue = []
+		self.__lock = Lock()
+		self.__ready = Event()
+		self.__queue = deque()
+		# Queued action per unit
+		self.__pending = {}
 		self.__sleep = Sleep()
 		self.__run = True
 		self.__thread = Thread(target=self.run, args=args, kwargs=kwargs)
 		self.__thread.start()
 	def run(self):
 		while self.__run:
-			action = self.get()
-			delay = action()
+			batch = self.get()
+			if len(batch) == 1:
+				delay = batch[0]()
+			else:
+				with ThreadPoolExecutor(max_workers=min(len(batch), MAX_WORKERS)) as ex:
+					delay = max((d for d in ex.map(lambda a: a(), batch) if d), default=None)
 			if delay:
 				self.__sleep(delay)
 	def abort(self):
 		self.__run = False
 		with self.__lock:
-			self.__queue = [lambda: None]
-			self.__lock.notify_all()
+			self.__queue.clear()
+			self.__pending.clear()
+			self.__queue.append(lambda: None)
+			self.__ready.set()
 		self.__sleep.wake()
 		self.__thread.join()
-		self.__queue = []
+		self.__queue.clear()
 	def add(self, action):
+		self.add_all([action])
+	def add_all(self, actions):
+		# Queue together so that independent actions end up in the same batch
 		with self.__lock:
-			self.__queue.append(action)
-			self.__lock.notify()
+			for action in actions:
+				self.__queue.append(action)
+				self.__pending[action.unit] = action
+			self.__ready.set()
 	def try_cancel(self, action):
 		with self.__lock:
-			for i in range(len(self.__queue)):
-				a = self.__queue[i]
-				if a == action:
-					if a.should_cancel(action):
-						print("Abort {} on {}".format(cmd_str[a.cmd], a.unit.name or a.unit.vmid))
-						del self.__queue[i]
-					return True
-		return False
+			a = self.__pending.get(action.unit)
+			if a is None:
+				return False
+			if a.should_cancel(action):
+				print("Abort {} on {}".format(cmd_str[a.cmd], a.unit.name or a.unit.vmid))
+				# Left in the queue, but skipped as it is no longer pending
+				del self.__pending[a.unit]
+			return True
 	def get(self):
-		with self.__lock:
-			while not len(self.__queue):
-				self.__lock.wait()
-			val = self.__queue[0]
-			del self.__queue[0]
-			return val
+		while True:
+			self.__ready.wait()
+			with self.__lock:
+				while self.__queue:
+					a = self.__queue.popleft()
+					if not isinstance(a, UnitAction):
+						return [a]
+					if not self.__take(a):
+						continue
+					batch = [a]
+					while self.__queue and batch[-1].batches_with(self.__queue[0]):
+						b = self.__queue.popleft()
+						if self.__take(b):
+							batch.append(b)
+					return batch
+				self.__ready.clear()
+	def __take(self, action):
+		# Cancelled actions are no longer pending
+		if self.__pending.get(action.unit) is not action:
+			return False
+		del self.__pending[action.unit]
+		return True
 
 def vm_list():
 	proc = qm.list()
-	proc.stdout.readline()
-	for line in proc.stdout.readlines():
-		line = line.decode().strip().split()
+	lines = proc.stdout.read().decode().splitlines()[1:]
+	proc.wait()
+	for line in lines:
+		line = line.split()
 		if len(line) != 6:
 			print("Unable to parse line: '{}'".format(line))
 			continue
 		(vmid, name, status, *_) = line
-		status = qm.status(vmid) # List is lying(paused=running), so check manually
-		status = str_status[status] if status in str_status else Status.UNKNOWN
+		status = str_status.get(status, Status.UNKNOWN)
 		yield VirtualUnit(qm, vmid, name=name, status=status)
-	proc.wait()
 
 def ct_list():
 	proc = pct.list()
-	proc.stdout.readline()
-	for line in proc.stdout.readlines():
-		line = line.decode().strip().split()
+	lines = proc.stdout.read().decode().splitlines()[1:]
+	proc.wait()
+	for line in lines:
+		line = line.split()
 		if len(line) == 4:
 			(vmid, status, _, name) = line
 		elif len(line) == 3:
@@ -272,38 +336,57 @@ def ct_list():
 		else:
 			print("Unable to parse line: '{}'".format(line))
 			continue
-		status = str_status[status] if status in str_status else Status.UNKNOWN
+		status = str_status.get(status, Status.UNKNOWN)
 		yield VirtualUnit(pct, vmid, name=name, status=status)
-	proc.wait()
+
+class Inventory:
+	def __init__(self, units):
+		self.units = units
+		# Reversed so that the first unit wins on duplicates
+		self.by_vmid = {u.vmid: u for u in reversed(units)}
+		self.by_name = {u.name: u for u in reversed(units) if u.name}
+
+_inventory_cache = None
+
+def build_inventory():
+	global _inventory_cache
+	if _inventory_cache is None:
+		_inventory_cache = Inventory([*ct_list(), *vm_list()])
+	return _inventory_cache
+
+def reset_inventory():
+	global _inventory_cache
+	_inventory_cache = None
+
+def virtual_prime(units):
+	# Each config is a separate subprocess, so fetch them concurrently
+	with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+		list(ex.map(VirtualUnit._prime_cache, units))
 
 def virtual_get_all():
-	for c in ct_list():
-		yield c
-	for v in vm_list():
-		yield v
+	return list(build_inventory().units)
 
 def virtual_get_onboot():
-	for u in virtual_get_all():
-		if u.onboot():
-			yield u
+	l = virtual_get_all()
+	virtual_prime(l)
+	return [u for u in l if u._onboot]
 
 def virtual_get_running():
-	for u in virtual_get_all():
-		if u.running():
-			yield u
+	return [u for u in virtual_get_all() if u.running()]
 
 def virtual_find(arg):
-	for c in ct_list():
-		if c.vmid == arg or c.name == arg or arg in c.tags():
-			return c
-	for v in vm_list():
-		if v.vmid == arg or v.name == arg or arg in v.tags():
-			return v
+	inv = build_inventory()
+	u = inv.by_vmid.get(arg) or inv.by_name.get(arg)
+	if u is not None:
+		return u
+	for u in inv.units:
+		if arg in u.tags():
+			return u
 	return None
 
 def virtual_prepare_start(vms=[]):
-	if vms is []:
-		l = [u for u in virtual_get_onboot()]
+	if not vms:
+		l = virtual_get_onboot()
 	else:
 		l = []
 		for vm in vms:
@@ -311,11 +394,12 @@ def virtual_prepare_start(vms=[]):
 			if u is None:
 				continue
 			l.append(u)
-	return sorted(l, key=VirtualUnit.order)
+		virtual_prime(l)
+	return sorted(l, key=lambda u: u._order)
 
 def virtual_prepare_shutdown(vms=[]):
-	if vms is []:
-		l = [u for u in virtual_get_running()]
+	if not vms:
+		l = virtual_get_running()
 	else:
 		l = []
 		for vm in vms:
@@ -323,7 +407,8 @@ def virtual_prepare_shutdown(vms=[]):
 			if u is None:
 				continue
 			l.append(u)
-	return sorted(l, key=VirtualUnit.order, reverse=True)
+	virtual_prime(l)
+	return sorted(l, key=lambda u: u._order, reverse=True)
 
 def main(argv):
 	def start_delay(unit):
@@ -352,13 +437,13 @@ def main(argv):
 			if len(cmds) == 0:
 				continue
 			(cmd, *args) = cmds
+			# Units are fetched at most once per command
+			reset_inventory()
 			# Command to one or more units
-			if cmd in str_cmd:
-				action = str_cmd[cmd]
-				for u in actions[action][0](args):
-					a = UnitAction(action, u, actions[action][1])
-					if not daemon.try_cancel(a):
-						daemon.add(a)
+			action = str_cmd.get(cmd, Cmd.UNKNOWN)
+			if action != Cmd.UNKNOWN:
+				l = [UnitAction(action, u, actions[action][1]) for u in actions[action][0](args)]
+				daemon.add_all([a for a in l if not daemon.try_cancel(a)])
 			elif cmd == "save":
 				if len(args) == 0:
 					continue
@@ -375,12 +460,12 @@ def main(argv):
 				if args[0] not in states:
 					print("State {} does not exist".format(args[0]))
 					continue
-				state = states[args[0]]
-				for u in virtual_prepare_start(state):
-					a = UnitAction(Cmd.START, u, start_delay)
-					if not daemon.try_cancel(a):
-						daemon.add(a)
-				del states[args[0]]
+				state = states.pop(args[0])
+				# An empty state would otherwise start all onboot units
+				if not state:
+					continue
+				l = [UnitAction(Cmd.START, u, start_delay) for u in virtual_prepare_start(state)]
+				daemon.add_all([a for a in l if not daemon.try_cancel(a)])
 			elif cmd == "list":
 				# Only for debugging
 				if len(args) == 0: